@@ -11,27 +11,215 @@ Changes
 import subprocess
 import os
 import json
+import hashlib
+import shutil
+import functools
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False # orjson is not installed, use stdlib json
 from typing import Dict, Optional, Any
 
 try:
-    from .utils import print_header, print_info, print_warn, print_error
+    from .utils import print_header, print_info, print_warn, print_error, HEVC_CODEC_NAMES
 except ImportError:
-    from utils import print_header, print_info, print_warn, print_error
+    from utils import print_header, print_info, print_warn, print_error, HEVC_CODEC_NAMES
+
+# Parser for raw (bytes) ffprobe JSON output.
+# orjson.JSONDecodeError subclasses json.JSONDecodeError, so error handling is shared.
+_json_loads = orjson.loads if ORJSON_AVAILABLE else json.loads
+
+# --- ffprobe Result Cache ---
+# Raw ffprobe output is cached on disk, keyed by (path, size, mtime) and the
+# ffprobe binary, so re-running a batch over unchanged files skips the probe entirely.
+# Set MKV_FACTORY_FFPROBE_CACHE=0 to disable it.
+FFPROBE_CACHE_ENABLED = os.environ.get('MKV_FACTORY_FFPROBE_CACHE', '1') != '0'
+FFPROBE_CACHE_DIR = os.path.join(
+    os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache'),
+    'mkv-factory', 'ffprobe'
+)
+# Bump whenever the ffprobe command lines change, so stale entries are never reused
+FFPROBE_CACHE_VERSION = 4
+
+# Stream/format fields actually consumed by the script (keep in sync when reading new fields).
+# Placed after -show_streams, this only trims the stream's own keys; tags and
+# side_data_list (DV configuration record) are still emitted in full.
+FFPROBE_STREAM_ENTRIES = (
+    'format=duration'
+    ':stream=index,codec_type,codec_name,profile,width,height,channels,'
+    'r_frame_rate,avg_frame_rate,start_time,color_primaries,color_transfer,color_space'
+)
+
+@functools.lru_cache(maxsize=None)
+def _ffprobe_identity() -> str:
+    """
+    Identifies the ffprobe binary in use (resolved path, size, mtime).
+    DV/HDR10+ detection depends on the ffprobe version, so upgrading it invalidates the cache.
+    """
+    path = shutil.which('ffprobe')
+    if path is None:
+        return ''
+    try:
+        path = os.path.realpath(path)
+        st = os.stat(path)
+    except OSError:
+        return path
+    return f"{path}\0{st.st_size}\0{st.st_mtime_ns}"
+
+def _ffprobe_cache_get(path: str, size: int, mtime: int) -> str:
+    """Returns the cache file path (without suffix) for a given file state."""
+    key = (
+        f"{FFPROBE_CACHE_VERSION}\0{_ffprobe_identity()}\0"
+        f"{os.path.abspath(path)}\0{size}\0{mtime}"
+    ).encode('utf-8', errors='surrogateescape')
+    digest = hashlib.blake2b(key, digest_size=16).hexdigest()
+    return os.path.join(FFPROBE_CACHE_DIR, digest)
+
+def _ffprobe_cache_path(source_file: str) -> Optional[str]:
+    """Stats the source file and returns its cache path, or None if it cannot be stat'ed (or caching is off)."""
+    if not FFPROBE_CACHE_ENABLED:
+        return None
+    try:
+        st = os.stat(source_file)
+    except OSError:
+        return None
+    return _ffprobe_cache_get(source_file, st.st_size, st.st_mtime_ns)
+
+def _ffprobe_cache_load(cache_path: Optional[str], suffix: str) -> Optional[Dict[str, Any]]:
+    """Returns the parsed cached ffprobe output, or None on a miss (or unreadable entry)."""
+    if not cache_path:
+        return None
+    try:
+        with open(cache_path + suffix, 'rb') as f:
+            return _json_loads(f.read())
+    except (OSError, ValueError):
+        return None
+
+# Cache write failures by source file. The probes may run in prefetch worker threads,
+# so they only record the error; analizuj_plik reports it on the main thread.
+_ffprobe_cache_errors: Dict[str, OSError] = {}
+
+def _ffprobe_cache_store(cache_path: Optional[str], suffix: str, payload: bytes) -> Optional[OSError]:
+    """
+    Atomically writes ffprobe output to the cache. Failures are not fatal:
+    prints nothing and returns the error (None on success or without a cache path).
+    """
+    if not cache_path:
+        return None
+    import tempfile # Only needed on a cache miss
+    try:
+        os.makedirs(FFPROBE_CACHE_DIR, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=FFPROBE_CACHE_DIR, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(payload)
+            os.replace(temp_path, cache_path + suffix)
+        except OSError:
+            os.remove(temp_path)
+            raise
+    except OSError as e:
+        return e
+    return None
+
+def _report_ffprobe_cache_error(source_file: str):
+    """Warns about a failed cache write recorded for this file (main thread only)."""
+    error = _ffprobe_cache_errors.pop(source_file, None)
+    if error is not None:
+        print_warn(f"Could not write ffprobe cache ({error}).")
 
 # --- Phase 1: Source File Analysis ---
 
-def analizuj_plik(source_file: str) -> (Dict[str, Any], Optional[float]):
-    """Uses ffprobe to analyze the file and returns streams and duration."""
-    print_header(f"Analyzing source file: {os.path.basename(source_file)}")
-    cmd = [
-        'ffprobe', '-v', 'quiet', '-print_format', 'json',
-        '-show_streams', '-show_format', source_file
-    ]
+def probe_source_file(source_file: str) -> Dict[str, Any]:
+    """
+    Runs the stream-level ffprobe (or reads it from the cache) and returns the parsed JSON.
+    Prints nothing (cache write failures are reported later by analizuj_plik),
+    so it is safe to call from a background thread (batch prefetch).
+    Raises subprocess.CalledProcessError / json.JSONDecodeError on failure.
+    """
+    cache_path = _ffprobe_cache_path(source_file)
+    data = _ffprobe_cache_load(cache_path, '.json')
+    if data is None:
+        cmd = [
+            'ffprobe', '-v', 'quiet', '-print_format', 'json',
+            '-show_streams', '-show_format',
+            '-show_entries', FFPROBE_STREAM_ENTRIES, source_file
+        ]
+        # '-v quiet' keeps stderr empty, so only stdout is piped (single direct read, no poll loop)
+        result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True)
+        data = _json_loads(result.stdout)
+        error = _ffprobe_cache_store(cache_path, '.json', result.stdout)
+        if error is not None:
+            _ffprobe_cache_errors[source_file] = error
+    return data
+
+def probe_frame_side_data(source_file: str, video_stream_index) -> Dict[str, Any]:
+    """
+    Runs the frame-level ffprobe on the first frame of the main video stream
+    (or reads it from the cache) and returns the parsed JSON. Prints nothing.
+    Raises subprocess.CalledProcessError / json.JSONDecodeError on failure.
+    """
+    cache_path = _ffprobe_cache_path(source_file)
+    data_frame = _ffprobe_cache_load(cache_path, '.frame.json')
+    if data_frame is None:
+        cmd_frame = [
+            'ffprobe', '-v', 'quiet', '-print_format', 'json',
+            '-show_frames', '-show_entries', 'frame=side_data_list',
+            '-select_streams', f"v:{video_stream_index}",
+            '-read_intervals', '%+#1', source_file
+        ]
+        result_frame = subprocess.run(cmd_frame, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True)
+        data_frame = _json_loads(result_frame.stdout)
+        error = _ffprobe_cache_store(cache_path, '.frame.json', result_frame.stdout)
+        if error is not None:
+            _ffprobe_cache_errors[source_file] = error
+    return data_frame
+
+def _transfer_allows_hdr10plus(transfer: Optional[str]) -> bool:
+    """HDR10+ only exists on PQ (SMPTE ST 2084) streams; an unreported transfer is given the benefit of the doubt."""
+    return not transfer or transfer in ('unknown', 'smpte2084')
+
+def prefetch_probes(source_file: str) -> Dict[str, Any]:
+    """
+    Background variant of the analysis probes (batch mode).
+    Returns the stream-level probe and, when analizuj_plik will need it,
+    also runs the frame-level probe so its result is already in the cache.
+    """
+    data = probe_source_file(source_file)
+    main_video = next((s for s in data.get('streams', []) if s.get('codec_type') == 'video'), None)
+    if main_video is not None:
+        has_stream_hdr10plus = any(
+            "hdr10+" in item.get('side_data_type', '').lower()
+            for item in main_video.get('side_data_list', [])
+        )
+        if not has_stream_hdr10plus and _transfer_allows_hdr10plus(main_video.get('color_transfer')):
+            try:
+                probe_frame_side_data(source_file, main_video.get('index', 0))
+            except (subprocess.CalledProcessError, ValueError):
+                pass # analizuj_plik re-runs the frame probe and reports the error
+    return data
+
+def analizuj_plik(
+    source_file: str,
+    probe_data: Optional[Dict[str, Any]] = None,
+    display_name: Optional[str] = None
+) -> (Dict[str, Any], Optional[float]):
+    """
+    Uses ffprobe to analyze the file and returns streams and duration.
+    'probe_data' can carry an already fetched stream-level probe (see prefetch_probes).
+    'display_name' overrides the file name shown in the header (defaults to the basename).
+    """
+    print_header(f"Analyzing source file: {display_name or os.path.basename(source_file)}")
     try:
         # --- PASS 1: STREAM-LEVEL PROBE ---
-        print_info("Running stream-level probe...")
-        result = subprocess.run(cmd, capture_output=True, text=True, check=True, encoding='utf-8')
-        data = json.loads(result.stdout)
+        if probe_data is None:
+            print_info("Running stream-level probe...")
+            data = probe_source_file(source_file)
+        else:
+            print_info("Using prefetched stream-level probe result.")
+            data = probe_data
+        # Also covers failures recorded by the prefetch workers
+        _report_ffprobe_cache_error(source_file)
 
         streams = {
             'video': [],
@@ -55,13 +243,6 @@ def analizuj_plik(source_file: str) -> (Dict[str, Any], Optional[float]):
         main_video_found = False
         main_video_stream_index = "0"
 
-        def parse_rational(r_str):
-            if isinstance(r_str, (int, float)): return float(r_str)
-            if '/' not in str(r_str): return float(r_str)
-            num, den = map(float, str(r_str).split('/'))
-            if den == 0: return 0.0
-            return num / den
-
         for stream in data.get('streams', []):
             codec_type = stream.get('codec_type')
 
@@ -83,6 +264,9 @@ def analizuj_plik(source_file: str) -> (Dict[str, Any], Optional[float]):
                             streams['has_hdr10plus'] = True
                             print_info("Found HDR10+ metadata in 'stream side_data'.")
 
+                        if streams['has_dv'] and streams['has_hdr10plus']:
+                            break # Nothing else is looked up in stream side data
+
                     if not streams['has_dv']:
                         tags = stream.get('tags', {})
                         comment = tags.get('comment', '')
@@ -94,11 +278,11 @@ def analizuj_plik(source_file: str) -> (Dict[str, Any], Optional[float]):
                     codec_name = stream.get('codec_name', 'unknown')
                     if codec_name == 'mjpeg':
                         print_info(f"Ignoring attached image/cover art (Index: {idx}, Codec: {codec_name}).")
-                    elif ('hevc' in codec_name or 'h265' in codec_name) and streams.get('dv_profile') == 7:
+                    elif codec_name in HEVC_CODEC_NAMES and streams.get('dv_profile') == 7:
                         # Only warn about EL if we detected profile 7 earlier
                         print_warn(f"Found a second HEVC video stream (Index: {idx}). Assuming Dolby Vision Enhancement Layer (EL) for Profile 7.")
                         print_warn("This EL stream will be IGNORED by ffmpeg mapping. RPU will be extracted and injected.")
-                    elif ('hevc' in codec_name or 'h265' in codec_name):
+                    elif codec_name in HEVC_CODEC_NAMES:
                          print_warn(f"Found an unexpected second HEVC video stream (Index: {idx}, Codec: {codec_name}). This stream will be IGNORED.")
                     else:
                          print_warn(f"Found an unexpected second video stream (Index: {idx}, Codec: {codec_name}). This stream will be IGNORED.")
@@ -117,17 +301,18 @@ def analizuj_plik(source_file: str) -> (Dict[str, Any], Optional[float]):
         # --- START 2ND PASS: FRAME-LEVEL PROBE (if needed for HDR10+) ---
         needs_frame_probe = not streams['has_hdr10plus'] # Check if we still need to find HDR10+
 
+        # HDR10+ only exists on PQ (SMPTE ST 2084) streams. If ffprobe already
+        # reported a different transfer (SDR, HLG), the second ffprobe spawn can be skipped.
+        main_transfer = streams['video'][0].get('color_transfer')
+        if needs_frame_probe and not _transfer_allows_hdr10plus(main_transfer):
+            print_info(f"Video transfer is '{main_transfer}' (not PQ). Skipping frame-level HDR10+ probe.")
+            needs_frame_probe = False
+
         if main_video_found and needs_frame_probe:
             print_info("Stream-level probe did not find HDR10+ metadata. Trying frame-level probe...")
-            stream_selector = f"v:{main_video_stream_index}"
-            cmd_frame = [
-                'ffprobe', '-v', 'quiet', '-print_format', 'json',
-                '-show_frames', '-select_streams', stream_selector,
-                '-read_intervals', '%+#1', source_file
-            ]
             try:
-                result_frame = subprocess.run(cmd_frame, capture_output=True, text=True, check=True, encoding='utf-8')
-                data_frame = json.loads(result_frame.stdout)
+                data_frame = probe_frame_side_data(source_file, main_video_stream_index)
+                _report_ffprobe_cache_error(source_file)
                 frames = data_frame.get('frames', [])
                 if frames:
                     frame_side_data = frames[0].get('side_data_list', [])
@@ -135,12 +320,13 @@ def analizuj_plik(source_file: str) -> (Dict[str, Any], Optional[float]):
                     for data_item in frame_side_data:
                         side_data_type = data_item.get('side_data_type', '').lower()
 
-                        if "hdr10+" in side_data_type and not streams['has_hdr10plus']:
+                        if "hdr10+" in side_data_type:
                             streams['has_hdr10plus'] = True
                             print_info("Found HDR10+ metadata in 'frame side_data'.")
+                            break # Nothing else is looked up in frame side data
 
             except subprocess.CalledProcessError as e:
-                print_warn(f"Frame-level probe failed: {e.stderr}")
+                print_warn(f"Frame-level probe failed: {e}")
             except json.JSONDecodeError:
                 print_warn("Failed to parse JSON from frame-level probe.")
             except Exception as e:
@@ -162,7 +348,6 @@ def analizuj_plik(source_file: str) -> (Dict[str, Any], Optional[float]):
 
     except subprocess.CalledProcessError as e:
         print_error(f"Error during file analysis (ffprobe): {e}")
-        if e.stderr: print_error(f"Error output: {e.stderr}")
         raise
     except json.JSONDecodeError:
         print_error("Error parsing JSON output from ffprobe.")
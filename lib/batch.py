@@ -5,25 +5,34 @@ MKV Factory - Batch Processing Module
 """
 
 import os
+import hashlib
 from typing import Dict
 
 try:
     from .utils import (
-        Kolory, print_k, print_info, print_warn, print_error, print_header
+        Kolory, print_k, print_info, print_warn, print_error, print_header,
+        buffered_output
     )
-    from .analysis import analizuj_plik
+    from .analysis import analizuj_plik, prefetch_probes
     from .config_automated import configure_automated_run
     from .processing import run_full_conversion
 except ImportError:
     # Fallback
     from utils import (
-        Kolory, print_k, print_info, print_warn, print_error, print_header
+        Kolory, print_k, print_info, print_warn, print_error, print_header,
+        buffered_output
     )
-    from analysis import analizuj_plik
+    from analysis import analizuj_plik, prefetch_probes
     from config_automated import configure_automated_run
     from processing import run_full_conversion
 
 
+# File extensions picked up from the source directory
+VIDEO_EXTENSIONS = frozenset({'.mkv', '.mp4', '.m2ts', '.ts', '.mov', '.webm'})
+
+# Max. number of background ffprobe workers prefetching stream info
+PROBE_PREFETCH_WORKERS = 8
+
 # --- Phase 4: Batch Processing Logic ---
 
 def run_batch_processing(source_dir: str, output_dir: str, profile_data: Dict, encoder_type: str):
@@ -35,11 +44,13 @@ def run_batch_processing(source_dir: str, output_dir: str, profile_data: Dict, e
     print_info(f"Output: {output_dir}")
     print_info(f"Encoder: {encoder_type}")
 
-    video_files = []
-    valid_extensions = ('.mkv', '.mp4', '.m2ts', '.ts', '.mov', '.webm')
-    for filename in os.listdir(source_dir):
-        if filename.lower().endswith(valid_extensions):
-            video_files.append(os.path.join(source_dir, filename))
+    # scandir provides is_file() from the directory entry, without an extra stat
+    # (symlinked files are still accepted; directories are skipped)
+    with os.scandir(source_dir) as entries:
+        video_files = [
+            entry.path for entry in entries
+            if os.path.splitext(entry.name)[1].lower() in VIDEO_EXTENSIONS and entry.is_file()
+        ]
 
     if not video_files:
         print_warn("No video files found in source directory.")
@@ -50,44 +61,69 @@ def run_batch_processing(source_dir: str, output_dir: str, profile_data: Dict, e
     success_count = 0
     fail_count = 0
 
-    for i, source_file in enumerate(video_files):
-        print_k(f"\n--- Processing File {i+1}/{len(video_files)}: {os.path.basename(source_file)} ---", Kolory.NAGLOWEK, bold=True)
-
-        # Unique ID for temp files
-        file_basename = os.path.splitext(os.path.basename(source_file))[0]
-        # Add hash to prevent name collisions
-        file_basename = f"{file_basename}_{hash(source_file) & 0xffff:04x}"
-
-
-        try:
-            streams, source_duration = analizuj_plik(source_file)
-
-            if not streams['video']:
-                print_warn("No video stream found. Skipping file.")
+    # Imported here: concurrent.futures (and the logging module it pulls in)
+    # is only needed in batch mode
+    from concurrent.futures import ThreadPoolExecutor
+
+    # Prefetch the ffprobe results (stream-level, plus frame-level when needed) in
+    # the background. ffprobe runs as a subprocess (the GIL is released while
+    # waiting), so probing the next files overlaps with the conversion of the current one.
+    prefetch_pool = ThreadPoolExecutor(max_workers=min(PROBE_PREFETCH_WORKERS, len(video_files)))
+    probe_futures = {f: prefetch_pool.submit(prefetch_probes, f) for f in video_files}
+
+    total_files = len(video_files)
+    try:
+        for i, source_file in enumerate(video_files):
+            display_name = os.path.basename(source_file)
+            print_k(f"\n--- Processing File {i+1}/{total_files}: {display_name} ---", Kolory.NAGLOWEK, bold=True)
+
+            # Unique ID for temp files
+            file_basename = os.path.splitext(display_name)[0]
+            # Add a stable path hash to prevent name collisions
+            # (hash() is randomized per interpreter run, BLAKE2 stays the same across runs)
+            path_digest = hashlib.blake2b(os.path.abspath(source_file).encode('utf-8', errors='surrogateescape'), digest_size=4).hexdigest()
+            file_basename = f"{file_basename}_{path_digest}"
+
+
+            try:
+                try:
+                    probe_data = probe_futures[source_file].result()
+                except Exception:
+                    # Let analizuj_plik re-run the probe and report the error itself
+                    probe_data = None
+
+                streams, source_duration = analizuj_plik(source_file, probe_data=probe_data, display_name=display_name)
+
+                if not streams['video']:
+                    print_warn("No video stream found. Skipping file.")
+                    fail_count += 1
+                    continue
+
+                # Non-interactive and chatty: emit its log lines in one write
+                with buffered_output():
+                    config_batch = configure_automated_run(
+                        streams,
+                        source_file,
+                        output_dir,
+                        source_duration,
+                        encoder_type,
+                        profile_data
+                    )
+
+                run_full_conversion(
+                    source_file,
+                    output_dir,
+                    config_batch,
+                    file_basename=file_basename
+                )
+                success_count += 1
+
+            except Exception as e:
+                print_error(f"FATAL: Failed to process file {source_file}: {e}")
+                print_warn("Continuing to the next file...")
                 fail_count += 1
-                continue
-
-            config_batch = configure_automated_run(
-                streams,
-                source_file,
-                output_dir,
-                source_duration,
-                encoder_type,
-                profile_data
-            )
-
-            run_full_conversion(
-                source_file,
-                output_dir,
-                config_batch,
-                file_basename=file_basename
-            )
-            success_count += 1
-
-        except Exception as e:
-            print_error(f"FATAL: Failed to process file {source_file}: {e}")
-            print_warn("Continuing to the next file...")
-            fail_count += 1
+    finally:
+        prefetch_pool.shutdown(wait=False, cancel_futures=True)
 
     print_header("Batch Processing Complete")
     print_k(f"Successfully processed: {success_count}", Kolory.OKGREEN)
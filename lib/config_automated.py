@@ -10,24 +10,89 @@ Changes:
 """
 
 import re
-from typing import List, Dict, Optional, Any
+import functools
+from typing import List, Dict, Optional, Any, NamedTuple, Pattern
 
 try:
     from .utils import (
         print_k, print_info, print_warn, print_error, print_header,
-        get_unique_filename, get_unique_languages,
+        get_unique_filename, sort_languages,
         generate_plex_friendly_name, format_stream_description, resolve_final_filename
     )
 except ImportError:
     from utils import (
         print_k, print_info, print_warn, print_error, print_header,
-        get_unique_filename, get_unique_languages,
+        get_unique_filename, sort_languages,
         generate_plex_friendly_name, format_stream_description, resolve_final_filename
     )
 
 
 # --- Phase 2b: Automated Configuration (Batch Mode) ---
 
+class CompiledPolicy(NamedTuple):
+    """Selection policy fields derived once per (audio/subtitle) profile block."""
+    policy_type: str
+    policy_languages: Any # 'all', a tuple of language codes, or None if invalid
+    default_lang: Optional[str]
+    codec_score: Dict[str, int]
+    exclusion_re: Optional[Pattern]
+    exclusion_by_lc: Dict[str, str]
+
+def _freeze(value: Any) -> Any:
+    """Returns a hashable snapshot of a JSON value (lists -> tuples, dicts -> sorted item tuples)."""
+    if isinstance(value, dict):
+        return tuple(sorted((key, _freeze(item)) for key, item in value.items()))
+    if isinstance(value, list):
+        return tuple(_freeze(item) for item in value)
+    return value
+
+def _normalize_policy_languages(languages: Any) -> Any:
+    """Validates a frozen 'languages' value once: 'all', a tuple of codes, or None (invalid)."""
+    if languages == 'all':
+        return languages
+    if isinstance(languages, tuple) and all(isinstance(lang, str) for lang in languages):
+        return languages
+    return None
+
+@functools.lru_cache(maxsize=16)
+def _compile_policy(policy_key: tuple) -> CompiledPolicy:
+    """
+    Derives codec scores and exclusion matchers from a frozen policy (see _freeze).
+    Cached, so a batch run compiles each profile block only once.
+    """
+    policy = dict(policy_key)
+
+    # Get codec preferences (weights)
+    codec_prefs = policy.get('preferred_codecs', ())
+    codec_score = {codec: (len(codec_prefs) - i) for i, codec in enumerate(codec_prefs)}
+
+    # Get exclusion rules, compiled into a single case-insensitive alternation.
+    # Patterns are escaped (literal), so matching stays linear.
+    exclusions = policy.get('exclude_titles_containing', ())
+    exclusion_re = re.compile('|'.join(map(re.escape, exclusions)), re.IGNORECASE) if exclusions else None
+    # Maps a matched (lowercased) text back to the rule as written in the profile
+    exclusion_by_lc = {exclusion.lower(): exclusion for exclusion in exclusions}
+
+    return CompiledPolicy(
+        policy_type=policy.get('policy', 'best_per_language'),
+        policy_languages=_normalize_policy_languages(policy.get('languages', ())),
+        default_lang=policy.get('default_track_language'),
+        codec_score=codec_score,
+        exclusion_re=exclusion_re,
+        exclusion_by_lc=exclusion_by_lc
+    )
+
+def _title_excluded(compiled: CompiledPolicy, lang: str, title: str) -> bool:
+    """Checks a stream title against the policy's exclusion rules (logs the match)."""
+    if not compiled.exclusion_re:
+        return False
+    match = compiled.exclusion_re.search(title)
+    if not match:
+        return False
+    rule = compiled.exclusion_by_lc.get(match.group(0).lower(), match.group(0))
+    print_info(f"Excluding stream (lang: {lang}, title: '{title}') due to exclusion rule: '{rule}'")
+    return True
+
 def find_best_tracks(
     available_streams: List[Dict],
     policy: Dict
@@ -41,16 +106,14 @@ def find_best_tracks(
     selected_streams = []
     default_indices = []
 
-    # Get codec preferences (weights)
-    codec_prefs = policy.get('preferred_codecs', [])
-    codec_score = {codec: (len(codec_prefs) - i) for i, codec in enumerate(codec_prefs)}
-
-    # Get exclusion rules
-    exclusions = policy.get('exclude_titles_containing', [])
+    # Nothing to select from (e.g. file has no subtitles)
+    if not available_streams:
+        return selected_streams, default_indices
 
-    # Get the defined policy type
-    policy_type = policy.get('policy', 'best_per_language')
-    default_lang = policy.get('default_track_language')
+    compiled = _compile_policy(_freeze(policy))
+    codec_get = compiled.codec_score.get # Bound once for the scoring key
+    policy_type = compiled.policy_type
+    default_lang = compiled.default_lang
 
     if policy_type == 'all':
         # --- POLICY "ALL" ---
@@ -58,41 +121,55 @@ def find_best_tracks(
         selected_streams = available_streams # Simply select all
 
         # We still respect the default_track_language
+        # Stop at the first match for the default lang
+        # (respecting subtitle 'default_mode: "first"')
         if default_lang:
-            for i, stream in enumerate(selected_streams):
-                lang = stream.get('tags', {}).get('language', 'und')
-                if lang == default_lang:
-                    default_indices.append(i)
-                    # Stop at the first match for the default lang
-                    # (respecting subtitle 'default_mode: "first"')
-                    break
+            default_index = next(
+                (i for i, stream in enumerate(selected_streams)
+                 if stream.get('tags', {}).get('language', 'und') == default_lang),
+                None
+            )
+            if default_index is not None:
+                default_indices.append(default_index)
 
     elif policy_type == 'best_per_language':
         # --- POLICY "BEST_PER_LANGUAGE" ---
 
-        # Get the raw language policy from profile.json
-        policy_languages = policy.get('languages', [])
+        # Get the language policy from profile.json (validated when compiled)
+        policy_languages = compiled.policy_languages
 
-        # Get all languages actually present in the file
-        available_langs_list = get_unique_languages(available_streams)
-        available_langs_set = set(available_langs_list)
+        if policy_languages is None:
+            print_error(f"Invalid 'languages' format in profile. Must be a list (e.g., ['eng']) or the string 'all'.")
+            return [], []
+
+        # An empty list disables this stream type; skip grouping entirely
+        if policy_languages == ():
+            print_info("Profile requests no languages for this track type.")
+            return [], []
+
+        # Group the streams by language once (single pass), flattening each
+        # one to (title, codec_name, stream) so the scoring loop below does
+        # no nested tag lookups. The keys are all languages in the file.
+        streams_by_lang = {}
+        for stream in available_streams:
+            tags = stream.get('tags', {})
+            streams_by_lang.setdefault(tags.get('language', 'und'), []).append(
+                (tags.get('title', ''), stream.get('codec_name', 'unknown'), stream)
+            )
 
         languages_to_process = []
 
         if policy_languages == "all":
             print_info("Profile policy is 'best_per_language' for 'all' languages.")
-            languages_to_process = available_langs_list # Use the sorted list
+            languages_to_process = sort_languages(streams_by_lang) # Use the sorted list
 
-        elif isinstance(policy_languages, list):
+        else:
             print_info(f"Profile requests languages: {', '.join(policy_languages)}")
             for lang in policy_languages:
-                if lang in available_langs_set:
+                if lang in streams_by_lang:
                     languages_to_process.append(lang)
                 else:
                     print_warn(f"Language '{lang.upper()}' (from profile) was NOT found in this file. Skipping it.")
-        else:
-            print_error(f"Invalid 'languages' format in profile. Must be a list (e.g., ['eng']) or the string 'all'.")
-            return [], []
 
         if not languages_to_process:
             print_info("No languages left to process after filtering.")
@@ -102,40 +179,25 @@ def find_best_tracks(
 
         # Loop through our validated list
         for lang in languages_to_process:
-            best_stream_for_lang = None
-            best_score = -1
-
-            # Find all streams for this language
-            streams_for_this_lang = [
-                s for s in available_streams
-                if s.get('tags', {}).get('language', 'und') == lang
-            ]
-
-            for stream in streams_for_this_lang:
-                # Check for title exclusions (e.g., "commentary")
-                title = stream.get('tags', {}).get('title', '').lower()
-                excluded = False
-                for exclusion in exclusions:
-                    if exclusion.lower() in title:
-                        print_info(f"Excluding stream (lang: {lang}, title: '{title}') due to exclusion rule: '{exclusion}'")
-                        excluded = True
-                        break
-                if excluded:
-                    continue
-
-                # Score the stream based on codec preferences
-                codec_name = stream.get('codec_name', 'unknown')
-                current_score = codec_score.get(codec_name, 1)
-
-                if current_score > best_score:
-                    best_score = current_score
-                    best_stream_for_lang = stream
+            # All streams for this language (pre-grouped above), minus title
+            # exclusions (e.g., "commentary"), filtered lazily as max() walks them
+            candidates = (
+                (codec_name, stream)
+                for title, codec_name, stream in streams_by_lang.get(lang, ())
+                if not _title_excluded(compiled, lang, title)
+            )
+
+            # Score the remaining streams based on codec preferences
+            # (max() keeps the first stream on a tie, like the old loop)
+            best = max(candidates, key=lambda candidate: codec_get(candidate[0], 1), default=None)
+            best_stream_for_lang = best[1] if best else None
 
             if best_stream_for_lang:
-                selected_streams.append(best_stream_for_lang)
                 # Check if this language should be the default track
+                # (its index is the position it's about to take)
                 if lang == default_lang:
-                    default_indices.append(len(selected_streams) - 1)
+                    default_indices.append(len(selected_streams))
+                selected_streams.append(best_stream_for_lang)
 
     else:
         # --- FALLBACK ---
@@ -144,6 +206,30 @@ def find_best_tracks(
 
     return selected_streams, default_indices
 
+# Default automated config; configure_automated_run() copies it per file.
+# Mutable values are replaced on every copy.
+_CONFIG_TEMPLATE: Dict[str, Any] = {
+    'audio_tracks': [],
+    'subtitle_tracks': [],
+    'external_audio_files': [],
+    'external_subtitle_files': [],
+    'has_dv': False,
+    'has_hdr10plus': False,
+    'dv_profile': None,
+    'final_filename': "",
+    'video_stream': None,
+    'default_audio_index': 0,
+    'default_subtitle_index': -1,
+    'encoder': None,
+    'encoder_params': {},
+    'auto_cleanup_temp_video': True,
+    'final_cleanup_policy': 'on_success',
+    'temp_dir': None, # None = output dir, 'auto' = RAM disk when safe, or a directory
+    'video_policy': 'encode',
+    'dv_policy': 'keep', # Default
+    'hdr10plus_policy': 'keep' # Default
+}
+
 def configure_automated_run(
     streams: Dict[str, Any],
     source_file: str,
@@ -156,26 +242,19 @@ def configure_automated_run(
 
     print_header("Step 2: Configure Automated Conversion")
 
-    config = {
-        'audio_tracks': [],
-        'subtitle_tracks': [],
-        'external_audio_files': [],
-        'external_subtitle_files': [],
-        'has_dv': streams.get('has_dv', False),
-        'has_hdr10plus': streams.get('has_hdr10plus', False),
-        'dv_profile': streams.get('dv_profile'),
-        'final_filename': "",
-        'video_stream': streams['video'][0],
-        'default_audio_index': 0,
-        'default_subtitle_index': -1,
-        'encoder': encoder_type,
-        'encoder_params': {},
-        'auto_cleanup_temp_video': True,
-        'final_cleanup_policy': 'on_success',
-        'video_policy': 'encode',
-        'dv_policy': 'keep', # Default
-        'hdr10plus_policy': 'keep' # Default
-    }
+    config = _CONFIG_TEMPLATE.copy()
+    # Fresh containers (the template's would be shared between files)
+    config['audio_tracks'] = []
+    config['subtitle_tracks'] = []
+    config['external_audio_files'] = []
+    config['external_subtitle_files'] = []
+    config['encoder_params'] = {}
+    # Source- and run-specific fields
+    config['has_dv'] = streams.get('has_dv', False)
+    config['has_hdr10plus'] = streams.get('has_hdr10plus', False)
+    config['dv_profile'] = streams.get('dv_profile')
+    config['video_stream'] = streams['video'][0]
+    config['encoder'] = encoder_type
 
     # 0. Video Policy
     config['video_policy'] = profile_data.get('video_policy', 'encode')
@@ -216,6 +295,7 @@ def configure_automated_run(
     cleanup_policy = profile_data.get('cleanup_policy', {})
     config['auto_cleanup_temp_video'] = cleanup_policy.get('auto_cleanup_temp_video', True)
     config['final_cleanup_policy'] = cleanup_policy.get('final_cleanup', 'on_success')
+    config['temp_dir'] = cleanup_policy.get('temp_dir')
     print_info(f"Cleanup policy: Auto-delete temp video={config['auto_cleanup_temp_video']}, Final cleanup={config['final_cleanup_policy']}")
 
     # 4. Audio Selection (Automated)
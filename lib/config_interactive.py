@@ -10,20 +10,20 @@ Changes:
 """
 
 import os
-import re
+import stat
 from typing import List, Dict, Optional, Any
 
 try:
     from .utils import (
-        Kolory, print_k, print_info, print_warn, print_error, print_header,
-        input_k, get_file_duration, get_unique_filename, get_unique_languages,
+        Kolory, print_k, print_info, print_warn, print_error, print_header, buffered_output,
+        input_k, get_file_duration, get_unique_filename, group_streams_by_language, sort_languages,
         sanitize_filename, generate_plex_friendly_name, format_stream_description, resolve_final_filename
     )
     from .validation import validate_encoder_param
 except ImportError:
     from utils import (
-        Kolory, print_k, print_info, print_warn, print_error, print_header,
-        input_k, get_file_duration, get_unique_filename, get_unique_languages,
+        Kolory, print_k, print_info, print_warn, print_error, print_header, buffered_output,
+        input_k, get_file_duration, get_unique_filename, group_streams_by_language, sort_languages,
         sanitize_filename, generate_plex_friendly_name, format_stream_description, resolve_final_filename
     )
     from validation import validate_encoder_param
@@ -46,23 +46,25 @@ def select_stream(
         print_info(f"No streams found for: {description}")
         return []
 
-    print_k(f"\nSelect {description}:", bold=True)
-    for i, stream in enumerate(stream_list):
-        print_k(f"  {i+1}. {format_stream_description(stream)}", Kolory.ENDC)
-
     prompt_options = [f"1-{len(stream_list)}"]
 
-    # Show "ALL" option only if allowed ---
-    if allow_all:
-        print_k(f"  ALL. ALL {len(stream_list)} tracks for this language", Kolory.ENDC)
-        prompt_options.append("ALL")
-
-    if allow_skip:
-        print_k("  0. Skip / Do not include", Kolory.ENDC)
-        prompt_options.insert(0, "0") # Add 0 to the front
-        default_choice = "0"
-    else:
-        default_choice = ""
+    # Draw the whole menu with a single write
+    with buffered_output():
+        print_k(f"\nSelect {description}:", bold=True)
+        for i, stream in enumerate(stream_list):
+            print_k(f"  {i+1}. {format_stream_description(stream)}", Kolory.ENDC)
+
+        # Show "ALL" option only if allowed ---
+        if allow_all:
+            print_k(f"  ALL. ALL {len(stream_list)} tracks for this language", Kolory.ENDC)
+            prompt_options.append("ALL")
+
+        if allow_skip:
+            print_k("  0. Skip / Do not include", Kolory.ENDC)
+            prompt_options.insert(0, "0") # Add 0 to the front
+            default_choice = "0"
+        else:
+            default_choice = ""
 
     prompt = f"Your choice ({', '.join(prompt_options)})"
     prompt += f" [{default_choice}]: " if allow_skip else ": "
@@ -79,18 +81,20 @@ def select_stream(
                 print_warn(f"Invalid choice. Please enter a number from 1 to {len(stream_list)}.")
                 continue
 
-        try:
-            choice = int(choice_str)
+        # Validate before int() so bad input doesn't go through ValueError
+        choice_str = choice_str.strip()
+        if not choice_str.isdecimal():
+            print_warn("Please enter a number.")
+            continue
 
-            if allow_skip and choice == 0:
-                return []
-            if 1 <= choice <= len(stream_list):
-                return [stream_list[choice - 1]]
+        choice = int(choice_str)
 
-            print_warn("Invalid choice, please try again.")
+        if allow_skip and choice == 0:
+            return []
+        if 1 <= choice <= len(stream_list):
+            return [stream_list[choice - 1]]
 
-        except ValueError:
-            print_warn("Please enter a number.")
+        print_warn("Invalid choice, please try again.")
 
 
 ### Helper function for interactive, language-based track selection
@@ -110,8 +114,9 @@ def _configure_internal_tracks(
         print_info(f"No internal {stream_type} streams found in the source file.")
         return []
 
-    # 1. Get and display unique languages
-    unique_langs = get_unique_languages(available_streams)
+    # 1. Group the streams by language (single pass) and display the languages
+    streams_by_lang = group_streams_by_language(available_streams)
+    unique_langs = sort_languages(streams_by_lang)
     print_k(f"\nFound {stream_type} streams in these languages:", bold=True)
     print_info(f"  {', '.join(lang.upper() for lang in unique_langs)}")
 
@@ -136,13 +141,12 @@ def _configure_internal_tracks(
             break # Valid choice: proceed with all languages
 
         # User entered a specific list. We must parse and validate it.
-        parsed_langs = [
-            lang for lang in re.split(r'[,\s]+', choice_str) if lang
-        ]
+        # Commas count as separators too; split() collapses whitespace runs
+        parsed_langs = choice_str.replace(',', ' ').split()
 
         valid_chosen_langs = []
         for lang in parsed_langs:
-            if lang in unique_langs:
+            if lang in streams_by_lang:
                 valid_chosen_langs.append(lang)
             else:
                 print_warn(f"Language '{lang}' not found in source. Skipping it.")
@@ -165,10 +169,7 @@ def _configure_internal_tracks(
     # 3. Iterate and select streams for each chosen language
     for lang in chosen_langs:
 
-        streams_for_this_lang = [
-            s for s in available_streams
-            if s.get('tags', {}).get('language', 'und') == lang
-        ]
+        streams_for_this_lang = streams_by_lang.get(lang, [])
 
         if not streams_for_this_lang:
             continue # Should not happen, but safe
@@ -265,6 +266,25 @@ def _ask_encoder_params(encoder_type: str) -> (Dict, bool):
 
     return encoder_params, auto_cleanup
 
+# Durations of external files already scanned this session,
+# keyed by (st_dev, st_ino, st_size, st_mtime_ns)
+_EXTERNAL_DURATION_CACHE: Dict[tuple, Optional[float]] = {}
+
+def _get_external_file_duration(path: str, st: os.stat_result) -> Optional[float]:
+    """
+    Returns the duration of an external file, scanning each file only once
+    (shared by the audio and subtitle prompts, so re-entered paths and
+    symlinks to the same file are free; a modified file is scanned again).
+    """
+    key = (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+    if key in _EXTERNAL_DURATION_CACHE:
+        print_info(f"Using previously scanned duration of: {path}")
+        return _EXTERNAL_DURATION_CACHE[key]
+
+    duration = get_file_duration(path)
+    _EXTERNAL_DURATION_CACHE[key] = duration
+    return duration
+
 def _prompt_for_external_file(
     stream_type: str,
     source_duration: Optional[float]
@@ -293,17 +313,27 @@ def _prompt_for_external_file(
         prompt_path = f"Enter path to external {type_label} file (or 'd' for done): "
         path = input_k(prompt_path).strip().strip("'\"")
 
-        if path.lower() == 'd':
+        # Compare without lowercasing the whole (possibly long) path
+        if path in ('d', 'D'):
             break
 
-        if not os.path.exists(path):
+        # One stat() both checks the path and keys the duration cache
+        try:
+            st = os.stat(path)
+        except OSError:
             print_warn("File not found. Please try again.")
             continue
+        if not stat.S_ISREG(st.st_mode):
+            print_warn("Not a regular file. Please try again.")
+            continue
+        if st.st_size == 0:
+            print_warn("File is empty. Please try again.")
+            continue
 
         # --- Duration Check ---
         should_continue = True
         if source_duration:
-            ext_duration = get_file_duration(path)
+            ext_duration = _get_external_file_duration(path, st)
             if ext_duration:
                 # Allow 1.0s difference
                 if abs(ext_duration - source_duration) > 1.0:
@@ -329,6 +359,22 @@ def _prompt_for_external_file(
 
     return external_files
 
+def _prompt_int_in_range(prompt: str, low: int, high: int, default: str) -> int:
+    """
+    Asks until the user enters a whole number from low to high (inclusive).
+    Empty input selects 'default'. Non-numeric input is rejected without int() raising.
+    """
+    while True:
+        choice_str = (input_k(prompt) or default).strip()
+        if not choice_str.isdecimal():
+            print_warn("Please enter a number.")
+            continue
+
+        choice = int(choice_str)
+        if low <= choice <= high:
+            return choice
+        print_warn("Invalid choice.")
+
 def configure_full_run(
     streams: Dict[str, Any],
     source_file: str,
@@ -356,6 +402,7 @@ def configure_full_run(
         'encoder_params': {},
         'auto_cleanup_temp_video': True, # Default for encode, ignored for passthrough
         'final_cleanup_policy': 'ask',
+        'temp_dir': None, # None = output dir, 'auto' = RAM disk when safe, or a directory
         'video_policy': 'encode',
         'dv_policy': 'keep', # Default
         'hdr10plus_policy': 'keep' # Default
@@ -380,11 +427,12 @@ def configure_full_run(
             # --- P5 SANITY CHECK (PART 1) ---
             # Check for P5 *immediately* after selecting encode
             if dv_profile_str == '5':
-                print_warn(f"Dolby Vision Profile 5 detected.")
-                print_warn(f"Encode policy (NVENC/AMF) is INCOMPATIBLE with IPT-PQ-C2.")
-                print_warn(f"The encoder **misinterprets** these colors during processing.")
-                print_warn(f"This **permanently corrupts** the output video (bakes in purple/green artifacts).")
-                print_warn("OVERRIDE: Forcing 'Pure Passthrough' mode (1:1 copy) **to prevent video corruption during processing**.")
+                with buffered_output():
+                    print_warn(f"Dolby Vision Profile 5 detected.")
+                    print_warn(f"Encode policy (NVENC/AMF) is INCOMPATIBLE with IPT-PQ-C2.")
+                    print_warn(f"The encoder **misinterprets** these colors during processing.")
+                    print_warn(f"This **permanently corrupts** the output video (bakes in purple/green artifacts).")
+                    print_warn("OVERRIDE: Forcing 'Pure Passthrough' mode (1:1 copy) **to prevent video corruption during processing**.")
 
                 # Force override config
                 config['video_policy'] = 'passthrough'
@@ -482,6 +530,7 @@ def configure_full_run(
         config['auto_cleanup_temp_video'] = cleanup_profile.get('auto_cleanup_temp_video', True)
         if 'final_cleanup' in cleanup_profile:
             config['final_cleanup_policy'] = cleanup_profile['final_cleanup']
+        config['temp_dir'] = cleanup_profile.get('temp_dir')
 
         # This check is now safe, it respects the P5 override
         if config['video_policy'] == 'encode':
@@ -546,47 +595,33 @@ def configure_full_run(
     print_k("\n--- Default Track Selection ---", Kolory.OKCYAN)
     all_audio_tracks = config['audio_tracks'] + config['external_audio_files']
     if len(all_audio_tracks) > 1:
-        print_k("Select default AUDIO track:", bold=True)
-        for i, track in enumerate(all_audio_tracks):
-            if 'codec_name' in track:
-                desc = format_stream_description(track)
-            else:
-                desc = f"[Ext.] {track['lang'].upper()} - {track['title']}"
-            print(f"  {i+1}. {desc}")
-        while True:
-            try:
-                choice_str = input_k(f"Your choice (1-{len(all_audio_tracks)}) [1]: ") or "1"
-                choice_idx = int(choice_str) - 1
-                if 0 <= choice_idx < len(all_audio_tracks):
-                    config['default_audio_index'] = choice_idx
-                    break
-                print_warn("Invalid choice.")
-            except ValueError:
-                print_warn("Please enter a number.")
+        with buffered_output():
+            print_k("Select default AUDIO track:", bold=True)
+            for i, track in enumerate(all_audio_tracks):
+                if 'codec_name' in track:
+                    desc = format_stream_description(track)
+                else:
+                    desc = f"[Ext.] {track['lang'].upper()} - {track['title']}"
+                print_k(f"  {i+1}. {desc}", Kolory.ENDC)
+        audio_count = len(all_audio_tracks)
+        audio_prompt = f"Your choice (1-{audio_count}) [1]: "
+        config['default_audio_index'] = _prompt_int_in_range(audio_prompt, 1, audio_count, "1") - 1
 
     all_subtitle_tracks = config['subtitle_tracks'] + config['external_subtitle_files']
     if len(all_subtitle_tracks) > 0:
-        print_k("Select default SUBTITLE track:", bold=True)
-        print("  0. None (No default subtitles)")
-        for i, track in enumerate(all_subtitle_tracks):
-            if 'codec_name' in track:
-                desc = format_stream_description(track)
-            else:
-                desc = f"[Ext.] {track['lang'].upper()} - {track['title']}"
-            print(f"  {i+1}. {desc}")
-        while True:
-            try:
-                choice_str = input_k(f"Your choice (0-{len(all_subtitle_tracks)}) [0]: ") or "0"
-                choice = int(choice_str)
-                if choice == 0:
-                    config['default_subtitle_index'] = -1
-                    break
-                elif 1 <= choice <= len(all_subtitle_tracks):
-                    config['default_subtitle_index'] = choice - 1
-                    break
-                print_warn("Invalid choice.")
-            except ValueError:
-                print_warn("Please enter a number.")
+        with buffered_output():
+            print_k("Select default SUBTITLE track:", bold=True)
+            print_k("  0. None (No default subtitles)", Kolory.ENDC)
+            for i, track in enumerate(all_subtitle_tracks):
+                if 'codec_name' in track:
+                    desc = format_stream_description(track)
+                else:
+                    desc = f"[Ext.] {track['lang'].upper()} - {track['title']}"
+                print_k(f"  {i+1}. {desc}", Kolory.ENDC)
+        subtitle_count = len(all_subtitle_tracks)
+        subtitle_prompt = f"Your choice (0-{subtitle_count}) [0]: "
+        # 0 (None) maps to -1, i.e. no default subtitle track
+        config['default_subtitle_index'] = _prompt_int_in_range(subtitle_prompt, 0, subtitle_count, "0") - 1
 
     return config
 
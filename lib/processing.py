@@ -11,15 +11,15 @@ Changes:
 """
 
 import os
-import re
 import json
 from typing import List, Dict, Optional, Any
+from xml.sax.saxutils import escape as xml_escape
 
 try:
     from lib.utils import (
         Kolory, print_k, print_info, print_warn, print_error, print_header,
         input_k, run_command, skasuj_plik, sprzataj_pliki,
-        sanitize_filename
+        sanitize_filename, select_temp_dir
     )
     # Import new strategy classes
     from lib.processing_strategies import (
@@ -29,7 +29,7 @@ except ImportError:
     from utils import (
         Kolory, print_k, print_info, print_warn, print_error, print_header,
         input_k, run_command, skasuj_plik, sprzataj_pliki,
-        sanitize_filename
+        sanitize_filename, select_temp_dir
     )
     # Fallback import
     from processing_strategies import (
@@ -39,6 +39,12 @@ except ImportError:
 
 # --- Phase 3: Process Execution ---
 
+# Extension for extracted subtitle tracks by codec; anything else goes into a .mks container
+SUBTITLE_EXTENSIONS = {
+    'hdmv_pgs_subtitle': 'sup',
+    'subrip': 'srt',
+}
+
 def run_extraction(
     source_file: str,
     output_dir: str,
@@ -103,13 +109,14 @@ def create_custom_hdr_tags_xml(output_dir: str, file_basename: str, config: Dict
 
     custom_tag_name = "HDR-format-info"
 
+    # Values are escaped so future tag text containing &, < or > stays valid XML
     xml_content = f"""<?xml version="1.0" encoding="UTF-8"?>
 <Tags>
   <Tag>
     <Targets />
     <Simple>
-      <Name>{custom_tag_name}</Name>
-      <String>{hdr_info_string}</String>
+      <Name>{xml_escape(custom_tag_name)}</Name>
+      <String>{xml_escape(hdr_info_string)}</String>
     </Simple>
   </Tag>
 </Tags>
@@ -131,7 +138,8 @@ def _create_video_processor(
     config: Dict[str, Any],
     source_file: str,
     output_dir: str,
-    file_basename: str
+    file_basename: str,
+    temp_prefix: Optional[str] = None
 ) -> VideoProcessor:
     """
     Factory function to create the correct video processing strategy
@@ -141,11 +149,11 @@ def _create_video_processor(
 
     if video_policy == 'passthrough':
         print_info("Selected strategy: PassthroughStrategy")
-        return PassthroughStrategy(config, source_file, output_dir, file_basename)
+        return PassthroughStrategy(config, source_file, output_dir, file_basename, temp_prefix)
 
     elif video_policy == 'encode':
         print_info("Selected strategy: EncodeStrategy")
-        return EncodeStrategy(config, source_file, output_dir, file_basename)
+        return EncodeStrategy(config, source_file, output_dir, file_basename, temp_prefix)
 
     else:
         # This should have been caught by validation, but as a fallback:
@@ -173,12 +181,26 @@ def run_full_conversion(
         file_basename = sane_basename
 
     # --- Define common temporary files ---
+    # All temp files of this conversion share this path prefix.
+    # By default they live next to the output; cleanup_policy.temp_dir can move them.
+    temp_dir = select_temp_dir(
+        output_dir, source_file, config.get('temp_dir'),
+        config.get('final_cleanup_policy'), config.get('auto_cleanup_temp_video', True)
+    )
+    if temp_dir == output_dir:
+        temp_prefix = os.path.join(output_dir, f"{file_basename}_temp_")
+    else:
+        # A shared directory: the PID keeps runs on the same source (e.g. into
+        # different output dirs) from overwriting each other's files
+        print_info(f"Temporary files will be written to: {temp_dir}")
+        temp_prefix = os.path.join(temp_dir, f"{file_basename}_{os.getpid()}_temp_")
     temp_audio_files = []
     temp_subtitle_files = []
     files_to_cleanup = [] # Will be populated based on the chosen path
 
     final_file_path = os.path.join(output_dir, config['final_filename'])
     custom_hdr_xml_path: Optional[str] = None
+    processor: Optional[VideoProcessor] = None
 
     if os.path.exists(final_file_path):
         print_warn(f"Output file already exists: {final_file_path}")
@@ -187,6 +209,10 @@ def run_full_conversion(
 
     try:
         # --- Common Steps: Extract Audio & Subtitles ---
+        # All selected tracks go into one mkvextract call, so the source
+        # is read once instead of once per track.
+        extract_specs = []
+
         print_header("Step 1: Extracting internal audio tracks")
         if not config['audio_tracks']:
             print_info("Skipped - no internal audio tracks selected.")
@@ -194,9 +220,8 @@ def run_full_conversion(
             for stream in config['audio_tracks']:
                 idx = stream['index']
                 lang = stream.get('tags', {}).get('language', 'und')
-                temp_file = os.path.join(output_dir, f"{file_basename}_temp_audio_{lang}_{idx}.mka")
-                cmd_audio = ['mkvextract', 'tracks', source_file, f'{idx}:{temp_file}']
-                run_command(cmd_audio)
+                temp_file = f"{temp_prefix}audio_{lang}_{idx}.mka"
+                extract_specs.append(f'{idx}:{temp_file}')
                 temp_audio_files.append({'path': temp_file, 'stream': stream})
                 files_to_cleanup.append(temp_file)
 
@@ -207,16 +232,17 @@ def run_full_conversion(
             for stream in config['subtitle_tracks']:
                 idx = stream['index']
                 lang = stream.get('tags', {}).get('language', 'und')
-                codec_name = stream.get('codec_name')
-                if codec_name == 'hdmv_pgs_subtitle': ext = 'sup'
-                elif codec_name == 'subrip': ext = 'srt'
-                else: ext = 'mks'
-                temp_file = os.path.join(output_dir, f"{file_basename}_temp_sub_{lang}_{idx}.{ext}")
-                cmd_subs = ['mkvextract', 'tracks', source_file, f'{idx}:{temp_file}']
-                run_command(cmd_subs)
+                ext = SUBTITLE_EXTENSIONS.get(stream.get('codec_name'), 'mks')
+                temp_file = f"{temp_prefix}sub_{lang}_{idx}.{ext}"
+                extract_specs.append(f'{idx}:{temp_file}')
                 temp_subtitle_files.append({'path': temp_file, 'stream': stream})
                 files_to_cleanup.append(temp_file)
 
+        if extract_specs:
+            print_info(f"Extracting {len(extract_specs)} track(s) in a single mkvextract pass.")
+            cmd_extract = ['mkvextract', 'tracks', source_file, *extract_specs]
+            run_command(cmd_extract)
+
         # --- Step 3: Generating Custom HDR Info Tags ---
         print_header("Step 3: Generating Custom HDR Info Tags")
         custom_hdr_xml_path = create_custom_hdr_tags_xml(
@@ -286,7 +312,8 @@ def run_full_conversion(
             config,
             source_file,
             output_dir,
-            file_basename
+            file_basename,
+            temp_prefix
         )
 
         # 2. Execute strategy
@@ -355,12 +382,16 @@ def run_full_conversion(
             cmd_mux.append(video_input_for_mux)
 
         # Add audio tracks
+        default_audio_index = config['default_audio_index']
         current_audio_index = 0
         for audio in temp_audio_files:
             stream = audio['stream']
-            lang = stream.get('tags', {}).get('language', 'und')
-            title = stream.get('tags', {}).get('title', f'{lang.upper()} {stream["codec_name"]}')
-            is_default = 'yes' if current_audio_index == config['default_audio_index'] else 'no'
+            tags = stream.get('tags', {})
+            lang = tags.get('language', 'und')
+            title = tags.get('title')
+            if title is None:
+                title = f'{lang.upper()} {stream["codec_name"]}'
+            is_default = 'yes' if current_audio_index == default_audio_index else 'no'
 
             raw_start_time = stream.get('start_time', '0.000000')
             try:
@@ -382,7 +413,7 @@ def run_full_conversion(
 
         # Ścieżki zewnętrzne (zostawiamy bez automatycznego sync, chyba że chcesz inaczej)
         for audio in config['external_audio_files']:
-            is_default = 'yes' if current_audio_index == config['default_audio_index'] else 'no'
+            is_default = 'yes' if current_audio_index == default_audio_index else 'no'
             cmd_mux.extend([
                 '--language', f'0:{audio["lang"]}',
                 '--track-name', f'0:{audio["title"]}',
@@ -392,14 +423,18 @@ def run_full_conversion(
             current_audio_index += 1
 
         # Add subtitle tracks
+        default_subtitle_index = config['default_subtitle_index']
         current_subtitle_index = 0
         for sub in temp_subtitle_files:
             # Słownik strumienia wyciągamy raz na początku pętli
             s_stream = sub['stream']
+            s_tags = s_stream.get('tags', {})
 
-            lang = s_stream.get('tags', {}).get('language', 'und')
-            title = s_stream.get('tags', {}).get('title', f'{lang.upper()} {s_stream["codec_name"]}')
-            is_default = 'yes' if current_subtitle_index == config['default_subtitle_index'] else 'no'
+            lang = s_tags.get('language', 'und')
+            title = s_tags.get('title')
+            if title is None:
+                title = f'{lang.upper()} {s_stream["codec_name"]}'
+            is_default = 'yes' if current_subtitle_index == default_subtitle_index else 'no'
 
             # --- POPRAWKA SYNC: Obsługa opóźnienia napisów ---
             s_start_time = s_stream.get('start_time', '0.000000')
@@ -439,9 +474,9 @@ def run_full_conversion(
             if input_k("\nDo you want to delete the remaining temporary files? [Y/n]: ").lower() != 'n':
                 sprzataj_pliki(files_to_cleanup)
             else:
-                print_info("Temporary files have been kept.")
+                print_info(f"Temporary files have been kept in: {temp_dir}")
         else:
-            print_info("Temporary files have been kept based on profile policy.")
+            print_info(f"Temporary files have been kept based on profile policy in: {temp_dir}")
 
     except Exception as e:
         print_error(f"The conversion process failed: {e}")
@@ -455,25 +490,33 @@ def run_full_conversion(
             if input_k("\nAn error occurred. Delete temporary files anyway? [y/N]: ").lower() == 'y':
                 should_cleanup = True
             else:
-                 print_info("Temporary files have been kept for debugging.")
+                 print_info(f"Temporary files have been kept for debugging in: {temp_dir}")
         else: # 'never' or 'on_success' (which failed)
-             print_info("Temporary files have been kept for debugging.")
+             print_info(f"Temporary files have been kept for debugging in: {temp_dir}")
 
         if should_cleanup:
-            if not files_to_cleanup:
-                 files_to_cleanup.extend([
-                     os.path.join(output_dir, f"{file_basename}_temp_video_raw.hevc"),
-                     os.path.join(output_dir, f"{file_basename}_temp_RPU_original.bin"),
-                     os.path.join(output_dir, f"{file_basename}_temp_RPU_P8_converted.bin"),
-                     os.path.join(output_dir, f"{file_basename}_temp_editor.json"),
-                     os.path.join(output_dir, f"{file_basename}_temp_video_converted.mkv"),
-                     os.path.join(output_dir, f"{file_basename}_temp_video_converted.hevc"),
-                     os.path.join(output_dir, f"{file_basename}_temp_video_final_dv.hevc"),
-                     os.path.join(output_dir, f"{file_basename}_temp_video_no_dv.hevc"),
-                     custom_hdr_xml_path if custom_hdr_xml_path else "",
-                     *[f['path'] for f in temp_audio_files],
-                     *[f['path'] for f in temp_subtitle_files]
-                 ])
+            # The strategy's temp files only join the list once process() succeeds,
+            # so add them here, plus every known temp name as a fallback
+            # (duplicates and missing files are skipped by sprzataj_pliki)
+            if processor is not None:
+                files_to_cleanup.extend(processor.get_temp_files())
+            files_to_cleanup.extend([
+                f"{temp_prefix}video_raw.hevc",
+                f"{temp_prefix}RPU_original.bin",
+                f"{temp_prefix}RPU_P8_converted.bin",
+                f"{temp_prefix}editor.json",
+                f"{temp_prefix}hdr10plus.json",
+                f"{temp_prefix}video_converted.mkv",
+                f"{temp_prefix}video_converted.hevc",
+                f"{temp_prefix}video_final_dv.hevc",
+                f"{temp_prefix}video_with_hdr10plus.hevc",
+                f"{temp_prefix}video_no_dv.hevc",
+                f"{temp_prefix}video_p8.hevc",
+                f"{temp_prefix}video_no_hdr10plus.hevc",
+                custom_hdr_xml_path if custom_hdr_xml_path else "",
+                *[f['path'] for f in temp_audio_files],
+                *[f['path'] for f in temp_subtitle_files]
+            ])
             sprzataj_pliki(files_to_cleanup)
 
         raise # Re-raise the exception
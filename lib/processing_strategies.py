@@ -11,29 +11,34 @@ Changes:
 
 import os
 import re
-import json
 from typing import List, Dict, Optional, Any
 
 try:
     from .utils import (
         Kolory, print_k, print_info, print_warn, print_error, print_header,
-        run_command, skasuj_plik
+        run_command, run_commands_concurrently, run_pipeline, skasuj_plik, HEVC_CODEC_NAMES
     )
 except ImportError:
     from utils import (
         Kolory, print_k, print_info, print_warn, print_error, print_header,
-        run_command, skasuj_plik
+        run_command, run_commands_concurrently, run_pipeline, skasuj_plik, HEVC_CODEC_NAMES
     )
 
+# dovi_tool editor config for the P7 -> P8 RPU conversion (mode 2), pre-encoded
+DV_EDITOR_P7_TO_P8 = b'{"mode": 2}'
+
 class VideoProcessor:
     """
     Base class for video processing strategies.
     """
-    def __init__(self, config: Dict[str, Any], source_file: str, output_dir: str, file_basename: str):
+    def __init__(self, config: Dict[str, Any], source_file: str, output_dir: str, file_basename: str,
+                 temp_prefix: Optional[str] = None):
         self.config = config
         self.source_file = source_file
         self.output_dir = output_dir
         self.file_basename = file_basename
+        # Path prefix of the intermediate files (see run_full_conversion)
+        self.temp_prefix = temp_prefix or os.path.join(output_dir, f"{file_basename}_temp_")
         self.temp_files: List[str] = [] # To track generated temp files
 
     def process(self) -> Dict[str, Any]:
@@ -49,6 +54,10 @@ class VideoProcessor:
         """
         raise NotImplementedError("Subclass must implement process method")
 
+    def _temp_path(self, suffix: str) -> str:
+        """Returns the path of a temp file for this conversion: <temp_prefix><suffix>."""
+        return f"{self.temp_prefix}{suffix}"
+
     def get_temp_files(self) -> List[str]:
         """Returns a list of temporary files created by this processor."""
         return self.temp_files
@@ -110,44 +119,49 @@ class PassthroughStrategy(VideoProcessor):
             # At least one operation is needed.
             print_header(f"Step 4: Configuring Hybrid Passthrough (Extracting raw HEVC)")
 
-            temp_video_raw = os.path.join(self.output_dir, f"{self.file_basename}_temp_video_raw.hevc")
-            self.temp_files.append(temp_video_raw)
-
-            cmd_extract_raw = ['mkvextract', 'tracks', self.source_file, f'{map_video}:{temp_video_raw}']
-            run_command(cmd_extract_raw)
+            # The raw stream is read only once, by the first tool in the chain,
+            # so it is piped straight from the source instead of being written
+            # to a temp file first (saves a full write + read of the video track)
+            cmd_extract_raw = [
+                'ffmpeg', '-v', 'error', '-nostdin',
+                '-i', self.source_file,
+                '-map', f'0:{map_video}',
+                '-c:v', 'copy', '-bsf:v', 'hevc_mp4toannexb',
+                '-f', 'hevc', '-'
+            ]
 
-            current_file_in = temp_video_raw
+            current_file_in = None # None = read the piped raw stream ('-')
 
             # --- Chain Step 2a: Dolby Vision Policy ---
             if dv_policy == 'convert7_to_8' and dv_profile_str == '7':
                 print_header(f"Step 5a: (Hybrid) Converting DV Profile (P7 -> P8)")
-                temp_video_p8 = os.path.join(self.output_dir, f"{self.file_basename}_temp_video_p8.hevc")
+                temp_video_p8 = self._temp_path("video_p8.hevc")
                 self.temp_files.append(temp_video_p8)
-                cmd_dv_convert = ['dovi_tool', '-m', '2', 'convert', '-i', current_file_in, '-o', temp_video_p8]
-                run_command(cmd_dv_convert)
+                cmd_dv_convert = ['dovi_tool', '-m', '2', 'convert', '-i', current_file_in or '-', '-o', temp_video_p8]
+                self._run_chain_step(cmd_extract_raw, cmd_dv_convert, current_file_in)
                 current_file_in = temp_video_p8
 
             elif dv_policy == 'drop' and has_dv:
                 print_header(f"Step 5a: (Hybrid) Stripping DV metadata")
-                temp_video_no_dv = os.path.join(self.output_dir, f"{self.file_basename}_temp_video_no_dv.hevc")
+                temp_video_no_dv = self._temp_path("video_no_dv.hevc")
                 self.temp_files.append(temp_video_no_dv)
-                cmd_dv_strip = ['dovi_tool', 'remove', '-i', current_file_in, '-o', temp_video_no_dv]
-                run_command(cmd_dv_strip)
+                cmd_dv_strip = ['dovi_tool', 'remove', '-i', current_file_in or '-', '-o', temp_video_no_dv]
+                self._run_chain_step(cmd_extract_raw, cmd_dv_strip, current_file_in)
                 current_file_in = temp_video_no_dv
 
             # --- Chain Step 2b: HDR10+ Policy ---
             if hdr10plus_policy == 'drop' and has_hdr10plus:
                 print_header(f"Step 5b: (Hybrid) Stripping HDR10+ metadata")
-                temp_video_no_hdr10plus = os.path.join(self.output_dir, f"{self.file_basename}_temp_video_no_hdr10plus.hevc")
+                temp_video_no_hdr10plus = self._temp_path("video_no_hdr10plus.hevc")
                 self.temp_files.append(temp_video_no_hdr10plus)
 
-                cmd_hdr_strip = ['hdr10plus_tool', 'remove', '-i', current_file_in, '-o', temp_video_no_hdr10plus]
-                run_command(cmd_hdr_strip)
-                current_file_in = temp_video_no_hdr10plus
+                cmd_hdr_strip = ['hdr10plus_tool', 'remove', '-i', current_file_in or '-', '-o', temp_video_no_hdr10plus]
+                self._run_chain_step(cmd_extract_raw, cmd_hdr_strip, current_file_in)
 
-            # --- Final cleanup of raw stream ---
-            if self.config['auto_cleanup_temp_video'] and current_file_in != temp_video_raw:
-                 skasuj_plik(temp_video_raw, label="raw temp video (post-hybrid-convert/strip)")
+                # The DV stage's output has been consumed; free its space right away
+                if current_file_in and self.config['auto_cleanup_temp_video']:
+                    skasuj_plik(current_file_in, label="intermediate hybrid video (post-HDR10+-strip)")
+                current_file_in = temp_video_no_hdr10plus
 
             # Return the final file in the chain
             return {
@@ -157,6 +171,14 @@ class PassthroughStrategy(VideoProcessor):
                 'input_type': 'raw_hevc'
             }
 
+    @staticmethod
+    def _run_chain_step(cmd_extract_raw: List[str], cmd: List[str], current_file_in: Optional[str]):
+        """Runs a hybrid chain step; the first one reads the raw stream piped from the source."""
+        if current_file_in is None:
+            run_pipeline(cmd_extract_raw, cmd)
+        else:
+            run_command(cmd)
+
 #
 # --- Strategy 2: ENCODE ---
 #
@@ -166,6 +188,44 @@ class EncodeStrategy(VideoProcessor):
     Uses a unified path for HEVC inputs to preserve metadata (DV, HDR10+)
     and a fallback path for non-HEVC inputs or HDR10-only.
     """
+    def _encoder_args(self, dynamic_vui_params: List[str]) -> List[str]:
+        """
+        Returns the ffmpeg encoder arguments (codec, rate control, pixel format, VUI)
+        for the configured encoder. Shared by both encode paths.
+        """
+        encoder_params = self.config['encoder_params']
+
+        if self.config['encoder'] == 'nvenc':
+            return [
+                '-c:v', 'hevc_nvenc',
+                '-preset', encoder_params['preset'],
+                '-tune', 'hq',
+                '-rc', 'vbr',
+                '-cq', str(encoder_params['cq']),
+                '-b:v', '0',
+                '-g', '96',
+                '-strict_gop', '1',
+                '-rc-lookahead', '32',
+                '-multipass', '2',
+                '-bf', '4',
+                '-b_ref_mode', 'middle',
+                '-spatial_aq', '1',
+                '-aq-strength', '8',
+                '-temporal_aq', '1',
+                '-pix_fmt', 'p010le',
+                *dynamic_vui_params
+            ]
+        elif self.config['encoder'] == 'amf':
+            qp = encoder_params['qp']
+            return [
+                '-c:v', 'hevc_amf', '-rc', 'cqp',
+                '-qp_p', qp, '-qp_i', qp, '-qp_b', qp,
+                '-quality', encoder_params['quality'],
+                '-g', '96', '-pix_fmt', 'p010le',
+                *dynamic_vui_params
+            ]
+        return []
+
     def process(self) -> Dict[str, Any]:
 
         video_stream_config = self.config.get('video_stream')
@@ -197,7 +257,7 @@ class EncodeStrategy(VideoProcessor):
 
         # --- Check if we need the complex injection path (Scenario A) ---
         # This is TRUE only if it's an HEVC file AND has dynamic metadata to preserve
-        is_hevc = 'hevc' in video_codec_name or 'h265' in video_codec_name
+        is_hevc = video_codec_name in HEVC_CODEC_NAMES
         has_dynamic_hdr = self.config['has_dv'] or self.config['has_hdr10plus']
 
         needs_injection_path = is_hevc and has_dynamic_hdr
@@ -209,8 +269,8 @@ class EncodeStrategy(VideoProcessor):
             path_name = "Dynamic HEVC Encode"
 
             # --- Define files ---
-            temp_video_raw = os.path.join(self.output_dir, f"{self.file_basename}_temp_video_raw.hevc")
-            temp_video_converted_hevc = os.path.join(self.output_dir, f"{self.file_basename}_temp_video_converted.hevc")
+            temp_video_raw = self._temp_path("video_raw.hevc")
+            temp_video_converted_hevc = self._temp_path("video_converted.hevc")
             self.temp_files.extend([temp_video_raw, temp_video_converted_hevc])
 
             # --- Step 1: Extract raw HEVC ---
@@ -232,29 +292,7 @@ class EncodeStrategy(VideoProcessor):
             cmd_convert.extend(['-i', temp_video_raw])
             # No -map_metadata here, as it would conflict with injection tools
 
-            if self.config['encoder'] == 'nvenc':
-                cmd_convert.extend([
-                    '-c:v', 'hevc_nvenc',
-                    '-preset', self.config['encoder_params']['preset'],
-                    '-tune', 'hq',
-                    '-rc', 'vbr',
-                    '-cq', str(self.config['encoder_params']['cq']),
-                    '-b:v', '0',
-                    '-g', '96',
-                    '-strict_gop', '1',
-                    '-rc-lookahead', '32',
-                    '-multipass', '2',
-                    '-bf', '4',
-                    '-b_ref_mode', 'middle',
-                    '-spatial_aq', '1',
-                    '-aq-strength', '8',
-                    '-temporal_aq', '1',
-                    '-pix_fmt', 'p010le'
-                ])
-                cmd_convert.extend(dynamic_vui_params)
-            elif self.config['encoder'] == 'amf':
-                cmd_convert.extend(['-c:v', 'hevc_amf', '-rc', 'cqp', '-qp_p', self.config['encoder_params']['qp'], '-qp_i', self.config['encoder_params']['qp'], '-qp_b', self.config['encoder_params']['qp'], '-quality', self.config['encoder_params']['quality'], '-g', '96', '-pix_fmt', 'p010le'])
-                cmd_convert.extend(dynamic_vui_params)
+            cmd_convert.extend(self._encoder_args(dynamic_vui_params))
 
             cmd_convert.append(temp_video_converted_hevc)
             run_command(cmd_convert)
@@ -263,35 +301,50 @@ class EncodeStrategy(VideoProcessor):
             current_file_to_inject = temp_video_converted_hevc
 
             # --- Step 3: Metadata Re-injection Chain ---
-
-            # --- Step 3a: Dolby Vision RPU ---
             dv_profile_str = str(self.config.get('dv_profile'))
+            inject_rpu = (
+                self.config['has_dv'] and dv_policy != 'drop' and
+                (dv_profile_str.startswith('7') or dv_profile_str.startswith('8'))
+            )
+            inject_hdr10plus = self.config['has_hdr10plus'] and hdr10plus_policy == 'keep'
+
+            # Extract the original metadata first. Both tools only read the
+            # raw stream, so they run concurrently (overlapping their reads).
+            metadata_extract_cmds = []
+            if inject_rpu:
+                temp_rpu_original = self._temp_path("RPU_original.bin")
+                self.temp_files.append(temp_rpu_original)
+                metadata_extract_cmds.append(['dovi_tool', 'extract-rpu', '-i', temp_video_raw, '-o', temp_rpu_original])
+            if inject_hdr10plus:
+                # HDR10+ metadata comes from the *original* raw file
+                temp_hdr10plus_json = self._temp_path("hdr10plus.json")
+                self.temp_files.append(temp_hdr10plus_json)
+                metadata_extract_cmds.append(['hdr10plus_tool', 'extract', '-i', temp_video_raw, '-o', temp_hdr10plus_json])
+
+            if metadata_extract_cmds:
+                print_header(f"Step 6: ({path_name}): Extracting original RPU / HDR10+ metadata")
+                run_commands_concurrently(metadata_extract_cmds)
 
+            # --- Step 3a: Dolby Vision RPU ---
             if self.config['has_dv'] and dv_policy != 'drop':
-                if dv_profile_str.startswith('7') or dv_profile_str.startswith('8'):
+                if inject_rpu:
                     print_info(f"DV Profile {dv_profile_str} detected. Re-injecting RPU.")
 
-                    temp_rpu_original = os.path.join(self.output_dir, f"{self.file_basename}_temp_RPU_original.bin")
-                    temp_video_final_dv = os.path.join(self.output_dir, f"{self.file_basename}_temp_video_final_dv.hevc")
-                    self.temp_files.extend([temp_rpu_original, temp_video_final_dv])
+                    temp_video_final_dv = self._temp_path("video_final_dv.hevc")
+                    self.temp_files.append(temp_video_final_dv)
 
                     rpu_to_inject = temp_rpu_original
 
-                    print_header(f"Step 6: ({path_name}): Extracting original RPU")
-                    cmd_rpu_extract = ['dovi_tool', 'extract-rpu', '-i', temp_video_raw, '-o', temp_rpu_original]
-                    run_command(cmd_rpu_extract)
-
                     if dv_profile_str == '7':
                         print_header(f"Step 6a: ({path_name}) Forcing RPU P7 -> P8.1 conversion")
                         print_info("Encode mode detected: P7 RPU must be converted to P8.1 to match the single-layer (BL-only) HEVC output.")
-                        temp_editor_json = os.path.join(self.output_dir, f"{self.file_basename}_temp_editor.json")
-                        temp_rpu_converted_p8 = os.path.join(self.output_dir, f"{self.file_basename}_temp_RPU_P8_converted.bin")
+                        temp_editor_json = self._temp_path("editor.json")
+                        temp_rpu_converted_p8 = self._temp_path("RPU_P8_converted.bin")
                         self.temp_files.extend([temp_editor_json, temp_rpu_converted_p8])
 
                         try:
-                            editor_config = {"mode": 2} # P7 -> P8 mode
-                            with open(temp_editor_json, 'w', encoding='utf-8') as f:
-                                json.dump(editor_config, f)
+                            with open(temp_editor_json, 'wb') as f:
+                                f.write(DV_EDITOR_P7_TO_P8)
                         except Exception as e:
                             print_error(f"Failed to write temporary editor config: {e}")
                             raise
@@ -317,6 +370,10 @@ class EncodeStrategy(VideoProcessor):
                         '-o', temp_video_final_dv
                     ]
                     run_command(cmd_inject)
+
+                    # The injected copy replaces the encoded stream; free its space right away
+                    if self.config['auto_cleanup_temp_video']:
+                        skasuj_plik(current_file_to_inject, label="encoded HEVC (post-RPU-injection)")
                     current_file_to_inject = temp_video_final_dv
 
                 else:
@@ -328,23 +385,20 @@ class EncodeStrategy(VideoProcessor):
                 print_info("No DV metadata detected. Skipping RPU steps.")
 
             # --- Step 3b: HDR10+ ---
-            if self.config['has_hdr10plus'] and hdr10plus_policy == 'keep':
-                print_header(f"Step 7b: ({path_name}) Extracting and Injecting HDR10+ metadata")
+            if inject_hdr10plus:
+                print_header(f"Step 7b: ({path_name}) Injecting HDR10+ metadata")
 
-                temp_hdr10plus_json = os.path.join(self.output_dir, f"{self.file_basename}_temp_hdr10plus.json")
-                temp_video_with_hdr10plus = os.path.join(self.output_dir, f"{self.file_basename}_temp_video_with_hdr10plus.hevc")
-                self.temp_files.extend([temp_hdr10plus_json, temp_video_with_hdr10plus])
+                temp_video_with_hdr10plus = self._temp_path("video_with_hdr10plus.hevc")
+                self.temp_files.append(temp_video_with_hdr10plus)
 
-                # 1. Extract HDR10+ metadata from the *original* raw file
-                cmd_hdr_extract = ['hdr10plus_tool', 'extract', '-i', temp_video_raw, '-o', temp_hdr10plus_json]
-                run_command(cmd_hdr_extract)
-
-                # 2. Inject metadata into the *current* file in the chain
+                # Inject metadata (extracted in Step 6) into the *current* file in the chain
                 # (which might already contain DV metadata)
                 cmd_hdr_inject = ['hdr10plus_tool', 'inject', '-i', current_file_to_inject, '-j', temp_hdr10plus_json, '-o', temp_video_with_hdr10plus]
                 run_command(cmd_hdr_inject)
 
-                # Update the chain
+                # Update the chain (the previous stage's file has been consumed)
+                if self.config['auto_cleanup_temp_video']:
+                    skasuj_plik(current_file_to_inject, label="encoded HEVC (post-HDR10+-injection)")
                 current_file_to_inject = temp_video_with_hdr10plus
 
                 if self.config['auto_cleanup_temp_video']:
@@ -380,7 +434,7 @@ class EncodeStrategy(VideoProcessor):
             path_name = "Simple Encode Path"
 
             # Save to MKV, to keep the original PTS
-            temp_video_converted_mkv = os.path.join(self.output_dir, f"{self.file_basename}_temp_video_converted.mkv")
+            temp_video_converted_mkv = self._temp_path("video_converted.mkv")
             self.temp_files.append(temp_video_converted_mkv)
 
             print_header(f"Step 4: ({path_name}) Encoding from source MKV")
@@ -396,29 +450,7 @@ class EncodeStrategy(VideoProcessor):
 
             cmd_convert.extend(['-an', '-sn'])
 
-            if self.config['encoder'] == 'nvenc':
-                cmd_convert.extend([
-                    '-c:v', 'hevc_nvenc',
-                    '-preset', self.config['encoder_params']['preset'],
-                    '-tune', 'hq',
-                    '-rc', 'vbr',
-                    '-cq', str(self.config['encoder_params']['cq']),
-                    '-b:v', '0',
-                    '-g', '96',
-                    '-strict_gop', '1',
-                    '-rc-lookahead', '32',
-                    '-multipass', '2',
-                    '-bf', '4',
-                    '-b_ref_mode', 'middle',
-                    '-spatial_aq', '1',
-                    '-aq-strength', '8',
-                    '-temporal_aq', '1',
-                    '-pix_fmt', 'p010le'
-                ])
-                cmd_convert.extend(dynamic_vui_params)
-            elif self.config['encoder'] == 'amf':
-                cmd_convert.extend(['-c:v', 'hevc_amf', '-rc', 'cqp', '-qp_p', self.config['encoder_params']['qp'], '-qp_i', self.config['encoder_params']['qp'], '-qp_b', self.config['encoder_params']['qp'], '-quality', self.config['encoder_params']['quality'], '-g', '96', '-pix_fmt', 'p010le'])
-                cmd_convert.extend(dynamic_vui_params)
+            cmd_convert.extend(self._encoder_args(dynamic_vui_params))
 
             cmd_convert.append(temp_video_converted_mkv)
             run_command(cmd_convert)
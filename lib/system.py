@@ -10,6 +10,7 @@ Changes
 
 import subprocess
 import shutil
+import functools
 from typing import Optional
 
 # Import helper functions from our own library
@@ -31,14 +32,33 @@ REQUIRED_TOOLS = [
 
 # --- Phase 0: Environment Check ---
 
-def check_encoder_support(encoder_name: str) -> bool:
-    """Checks if ffmpeg supports a specific encoder."""
+@functools.lru_cache(maxsize=None)
+def _list_encoders() -> frozenset:
+    """
+    Returns the names of all encoders built into ffmpeg (one 'ffmpeg -encoders' call per process).
+    Empty if ffmpeg is missing or fails.
+    """
     try:
-        cmd = ['ffmpeg', '-h', f'encoder={encoder_name}']
+        cmd = ['ffmpeg', '-hide_banner', '-encoders']
         result = subprocess.run(cmd, capture_output=True, text=True, check=True)
-        return True
     except (subprocess.CalledProcessError, FileNotFoundError):
-        return False
+        return frozenset()
+
+    # Listing format: legend, a ' ------' separator, then ' V....D hevc_nvenc   Description'
+    encoders = set()
+    in_list = False
+    for line in result.stdout.splitlines():
+        parts = line.split(None, 2)
+        if not in_list:
+            in_list = parts == ['------']
+            continue
+        if len(parts) >= 2:
+            encoders.add(parts[1])
+    return frozenset(encoders)
+
+def check_encoder_support(encoder_name: str) -> bool:
+    """Checks if ffmpeg supports a specific encoder."""
+    return encoder_name in _list_encoders()
 
 def check_tools_and_encoders() -> Optional[str]:
     """
@@ -16,6 +16,7 @@ import shutil
 import re
 import datetime
 import string
+import contextlib
 try:
     import colorama
     COLORAMA_AVAILABLE = True
@@ -31,6 +32,11 @@ from typing import List, Dict, Optional, Any
 LOG_FILE: Optional[Any] = None
 ANSI_ESCAPE = re.compile(r'\x1B(?:[@-Z\\-_]|\[[0-?]*[ -/]*[@-~])')
 UNIDECODE_WARNING_SHOWN = False
+# Set by buffered_output(); while it's a list, print_k appends instead of printing
+OUTPUT_BUFFER: Optional[List] = None
+
+# ffprobe codec names that identify an HEVC video stream
+HEVC_CODEC_NAMES = frozenset({'hevc', 'h265'})
 
 
 # --- Helper Classes for Logic ---
@@ -54,6 +60,7 @@ def print_k(text: str, color: str = Kolory.OKGREEN, bold: bool = False):
     """
     Prints colored text to console (no timestamp).
     Prints timestamped, clean text to log file (if configured).
+    Inside buffered_output() both are collected and written on exit.
     """
     global LOG_FILE
 
@@ -61,30 +68,65 @@ def print_k(text: str, color: str = Kolory.OKGREEN, bold: bool = False):
 
     # --- 1. Console Output (No Timestamp) ---
     formatted_text = f"{b}{color}{text}{Kolory.ENDC}"
-    print(formatted_text)
 
     # --- 2. Log File Output (With Timestamp) ---
+    log_line = None
     if LOG_FILE:
-        try:
-            # Generate timestamp *only* when writing to the log
-            ts = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        # Generate timestamp *only* when writing to the log
+        ts = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
-            # Strip colors from the formatted text to get a clean log entry
-            # This 'clean_text' does NOT have a timestamp yet
-            clean_text = ANSI_ESCAPE.sub('', formatted_text)
+        # Strip colors from the formatted text to get a clean log entry,
+        # then prepend the timestamp
+        clean_text = ANSI_ESCAPE.sub('', formatted_text)
+        log_line = f"[{ts}] {clean_text}\n"
 
-            # Prepend timestamp to the *clean* text
-            prefixed_clean_text = f"[{ts}] {clean_text}"
+    if OUTPUT_BUFFER is not None:
+        OUTPUT_BUFFER.append((formatted_text, log_line))
+        return
 
-            LOG_FILE.write(prefixed_clean_text + '\n')
-            LOG_FILE.flush()
-        except Exception as e:
-            # Fallback in case of write error
-            # Print the error *to the console*, but with a timestamp
-            # to make it clear it's a logging system error.
-            ts_err = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            print(f"[{ts_err}] ❌ Log write error: {e}")
-            LOG_FILE = None
+    print(formatted_text)
+    if log_line:
+        _write_log(log_line)
+
+def _write_log(data: str):
+    """Writes (already timestamped) lines to LOG_FILE, disabling it on error."""
+    global LOG_FILE
+
+    try:
+        LOG_FILE.write(data)
+        LOG_FILE.flush()
+    except Exception as e:
+        # Fallback in case of write error
+        # Print the error *to the console*, but with a timestamp
+        # to make it clear it's a logging system error.
+        ts_err = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        print(f"[{ts_err}] ❌ Log write error: {e}")
+        LOG_FILE = None
+
+@contextlib.contextmanager
+def buffered_output():
+    """
+    Collects print_k output and writes it with one console write and one
+    log write on exit, instead of a write + flush per line.
+    Only for non-interactive phases (no input_k inside). Nesting is a no-op.
+    """
+    global OUTPUT_BUFFER
+
+    if OUTPUT_BUFFER is not None:
+        yield
+        return
+
+    OUTPUT_BUFFER = []
+    try:
+        yield
+    finally:
+        buffered, OUTPUT_BUFFER = OUTPUT_BUFFER, None
+        if buffered:
+            sys.stdout.write('\n'.join(text for text, _ in buffered) + '\n')
+            sys.stdout.flush()
+            log_data = ''.join(line for _, line in buffered if line)
+            if log_data and LOG_FILE:
+                _write_log(log_data)
 
 def print_info(text: str):
     print_k(f"INFO: {text}", Kolory.OKCYAN)
@@ -321,6 +363,141 @@ def run_command(cmd: List[str], cwd: str = None):
         print_error(f"An unexpected error occurred in run_command: {e}")
         raise
 
+def run_commands_concurrently(cmds: List[List[str]], cwd: str = None):
+    """
+    Runs independent commands at the same time (one thread each, via run_command).
+    Meant for silent tools (dovi_tool, hdr10plus_tool) reading the same input,
+    so their I/O overlaps. Waits for all of them; re-raises the first failure.
+    """
+    if len(cmds) == 1:
+        run_command(cmds[0], cwd=cwd)
+        return
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    with ThreadPoolExecutor(max_workers=len(cmds)) as pool:
+        futures = [pool.submit(run_command, cmd, cwd) for cmd in cmds]
+
+    # Leaving the 'with' block waited for every command
+    for future in futures:
+        future.result()
+
+# RAM-backed directory for the intermediate files (Linux tmpfs), used with temp_dir 'auto'
+RAM_TEMP_DIR = '/dev/shm'
+# Memory required for it, as a multiple of the source size
+# (the encode chain holds up to ~3 video-sized intermediates at once)
+RAM_TEMP_HEADROOM = 3
+# Memory left over for the tools themselves (ffmpeg, encoder driver, mkvmerge)
+RAM_TEMP_RESERVE = 4 * 1024**3
+
+def _available_memory() -> Optional[int]:
+    """Returns MemAvailable from /proc/meminfo in bytes, or None if unknown."""
+    try:
+        with open('/proc/meminfo', 'r', encoding='ascii') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+def select_temp_dir(
+    output_dir: str,
+    source_file: str,
+    temp_dir_setting: Optional[str] = None,
+    final_cleanup_policy: Optional[str] = None,
+    auto_cleanup_temp_video: bool = True
+) -> str:
+    """
+    Picks the directory for a conversion's temp files (cleanup_policy.temp_dir).
+    - Not set: output_dir.
+    - 'auto': RAM_TEMP_DIR, but only with final cleanup 'always' (a kept file
+      would hold RAM until reboot), auto_cleanup_temp_video on (the headroom
+      assumes intermediates are deleted once consumed) and when the memory
+      is actually available. Otherwise output_dir.
+    - Anything else: that directory.
+    """
+    if not temp_dir_setting:
+        return output_dir
+    if temp_dir_setting != 'auto':
+        return temp_dir_setting
+
+    if final_cleanup_policy != 'always':
+        print_info(f"temp_dir 'auto': final cleanup '{final_cleanup_policy}' can keep temp files. Using the output directory.")
+        return output_dir
+    if not auto_cleanup_temp_video:
+        print_info("temp_dir 'auto': auto_cleanup_temp_video is off, so all intermediates are kept until the end. Using the output directory.")
+        return output_dir
+
+    # tmpfs 'free' is only its size limit; MemAvailable is what can really be used
+    try:
+        needed = os.path.getsize(source_file) * RAM_TEMP_HEADROOM
+        tmpfs_free = shutil.disk_usage(RAM_TEMP_DIR).free
+    except OSError:
+        print_info(f"temp_dir 'auto': {RAM_TEMP_DIR} is not available. Using the output directory.")
+        return output_dir
+    available = _available_memory()
+    if available is None or tmpfs_free < needed or available < needed + RAM_TEMP_RESERVE:
+        print_info("temp_dir 'auto': not enough free memory for the temp files. Using the output directory.")
+        return output_dir
+    return RAM_TEMP_DIR
+
+def run_pipeline(producer: List[str], consumer: List[str], cwd: str = None):
+    """
+    Runs 'producer | consumer': the producer's stdout feeds the consumer's
+    stdin directly, so no intermediate file is written to disk.
+    - The producer's stderr goes to the console (keep it quiet, e.g. ffmpeg -v error).
+    - The consumer's output is collected and printed like run_command's fast path.
+    - Raises CalledProcessError if either side fails.
+    """
+    print_k(f"$ {' '.join(producer)} | {' '.join(consumer)}", Kolory.OKBLUE)
+
+    try:
+        producer_process = subprocess.Popen(producer, cwd=cwd, stdout=subprocess.PIPE)
+        try:
+            consumer_process = subprocess.Popen(
+                consumer,
+                text=True,
+                encoding='utf-8',
+                errors='replace', # Prevents crash on non-UTF-8 chars from tools
+                cwd=cwd,
+                stdin=producer_process.stdout,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT
+            )
+        except BaseException:
+            producer_process.kill()
+            producer_process.wait()
+            raise
+        finally:
+            # Only the consumer holds the read end now, so the producer
+            # gets SIGPIPE (instead of blocking) if the consumer exits early
+            producer_process.stdout.close()
+
+        print_info(f"Running '{consumer[0]}' on piped input. Waiting for completion...")
+        stdout_data, _ = consumer_process.communicate()
+        producer_return_code = producer_process.wait()
+
+        if stdout_data:
+            for line in stdout_data.splitlines():
+                if line.strip():
+                    print_k(f"  [Tool] {line.strip()}", Kolory.OKBLUE)
+
+        # The consumer's failure is the more telling one (it may have made the producer hit SIGPIPE)
+        if consumer_process.returncode != 0:
+            raise subprocess.CalledProcessError(consumer_process.returncode, consumer)
+        if producer_return_code != 0:
+            raise subprocess.CalledProcessError(producer_return_code, producer)
+
+        print_k("OK: Command executed successfully.", Kolory.OKGREEN)
+
+    except subprocess.CalledProcessError as e:
+        print_error(f"Error executing command: {e}")
+        raise
+    except FileNotFoundError as e:
+        print_error(f"Command not found: {e.filename}. Is it in PATH?")
+        raise
+
 def skasuj_plik(filepath: str, label: str = "temporary file"):
     """Safely deletes a single file if it exists."""
     try:
@@ -333,11 +510,16 @@ def skasuj_plik(filepath: str, label: str = "temporary file"):
 def sprzataj_pliki(files_to_cleanup: List[str]):
     """Deletes a list of temporary files."""
     print_header("Step 8: Cleaning up temporary files")
-    for f in files_to_cleanup:
+    # dict.fromkeys: drop duplicate entries (keeping order), so each path
+    # costs a single unlink(); already-deleted files are simply skipped
+    for f in dict.fromkeys(files_to_cleanup):
+        if not f:
+            continue
         try:
-            if os.path.exists(f):
-                os.remove(f)
-                print_info(f"Deleted: {f}")
+            os.remove(f)
+            print_info(f"Deleted: {f}")
+        except FileNotFoundError:
+            pass
         except OSError as e:
             print_warn(f"Failed to delete temporary file: {f} ({e})")
 
@@ -447,21 +629,31 @@ def resolve_final_filename(output_dir: str, desired_filename: str) -> str:
 
     return unique_filename
 
-### Helper function to get unique languages from a stream list
-def get_unique_languages(stream_list: List[Dict[str, Any]]) -> List[str]:
-    """Extracts a sorted list of unique language codes from streams."""
-    languages = set()
+### Helper function to group streams by language in a single pass
+def group_streams_by_language(stream_list: List[Dict[str, Any]]) -> Dict[str, List[Dict[str, Any]]]:
+    """
+    Groups streams by language code, keeping the source order within each group.
+    Lets callers look up all streams of a language without rescanning the list.
+    """
+    groups = {}
     for stream in stream_list:
         # 'und' is the standard code for 'undefined'
         lang = stream.get('tags', {}).get('language', 'und')
-        languages.add(lang)
+        groups.setdefault(lang, []).append(stream)
+    return groups
 
-    # Sort the list, but make sure 'und' (undefined) is always last
-    sorted_langs = sorted([lang for lang in languages if lang != 'und'])
+def sort_languages(languages) -> List[str]:
+    """Sorts language codes, but makes sure 'und' (undefined) is always last."""
+    sorted_langs = sorted(lang for lang in languages if lang != 'und')
     if 'und' in languages:
         sorted_langs.append('und')
     return sorted_langs
 
+### Helper function to get unique languages from a stream list
+def get_unique_languages(stream_list: List[Dict[str, Any]]) -> List[str]:
+    """Extracts a sorted list of unique language codes from streams."""
+    return sort_languages(group_streams_by_language(stream_list))
+
 def generate_plex_friendly_name(source_filename: str, config: Dict) -> str:
     """
     Generates a clean filename based on source filename and config.
@@ -524,7 +716,7 @@ def generate_plex_friendly_name(source_filename: str, config: Dict) -> str:
     if config.get('video_policy') == 'passthrough':
         # Determine source codec for the tag
         source_codec = config['video_stream'].get('codec_name', 'COPY')
-        if 'hevc' in source_codec or 'h265' in source_codec:
+        if source_codec in HEVC_CODEC_NAMES:
             quality_tags.append("HEVC")
         elif 'avc' in source_codec or 'h264' in source_codec:
              quality_tags.append("H.264")
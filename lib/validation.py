@@ -8,6 +8,7 @@ Changes:
 - introduce validation of keep, drop, convert HDR policies
 """
 
+import os
 from typing import Dict, Any
 
 # Import helper functions from lib
@@ -200,6 +201,10 @@ def validate_profile_globally(profile_data: Dict, detected_encoder: str):
         if final_clean is not None and final_clean not in valid_policies:
             raise ValueError(f"'cleanup_policy.final_cleanup' must be one of {valid_policies}.")
 
+        temp_dir = cleanup.get('temp_dir')
+        if temp_dir is not None and temp_dir != 'auto' and (not isinstance(temp_dir, str) or not os.path.isdir(temp_dir)):
+            raise ValueError("'cleanup_policy.temp_dir' must be 'auto' or the path of an existing directory.")
+
     # 5. Validate Logging
     logging = profile_data.get('logging')
     if logging: